@@ -12,11 +12,21 @@ Installation:
 
 import gimpfu
 import gimp
+import heapq
+from collections import Counter
 import os
 import struct
-from math import sqrt
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 BIN_PREFIX = 0xFE
+# BLOAD header: prefix, start, end and execution addresses
+BIN_HEADER = struct.Struct('<BHHH')
+# DAT header: width and height
+DAT_HEADER = struct.Struct('<HH')
 DEFAULT_FILENAME = 'NONAME'
 DEFAULT_VRES = 'v212'
 DEFAULT_OUTPUT_DIR = os.getcwd()
@@ -28,30 +38,111 @@ MAX_DAT_HEIGHT = 212
 MAX_PAGES = 4
 PALETTE_OFFSET = 0x7680
 FIXED_DITHERING = 3
+# progress bar updates per pass; each one is a PDB round-trip
+PROGRESS_UPDATES = 50
+# palette refinement passes after merging colours
+KMEANS_ITERATIONS = 10
+
+# 9-bit palette level of every channel value: round(v / 255 * 7) << 5
+LEVELS = [(v * 7 + 127) // 255 << 5 for v in range(256)]
+
+# Dithering method, 0 and 1 also accept the old boolean option
+NO_DITHERING = 0
+ERROR_DIFFUSION = 1
+ORDERED_DITHERING = 2
+
+# 8x8 Bayer matrix as offsets added before rounding to the 9-bit grid,
+# spanning one level step (255 / 7) centred on zero
+BAYER_8X8 = ((0, 32, 8, 40, 2, 34, 10, 42),
+             (48, 16, 56, 24, 50, 18, 58, 26),
+             (12, 44, 4, 36, 14, 46, 6, 38),
+             (60, 28, 52, 20, 62, 30, 54, 22),
+             (3, 35, 11, 43, 1, 33, 9, 41),
+             (51, 19, 59, 27, 49, 17, 57, 25),
+             (15, 47, 7, 39, 13, 45, 5, 37),
+             (63, 31, 55, 23, 61, 29, 53, 21))
+BAYER_OFFSETS = [[int(round(((m + 0.5) / 64 - 0.5) * 255 / 7)) for m in row] for row in BAYER_8X8]
 
 # Base image type
 RGB = 0
 GRAY = 1
 INDEXED = 2
 
-tuple_key = lambda pair: pair[0]
-tuple_value = lambda pair: pair[1]
-
 
-def create_distance_query(palette):
-    palmap = {k:v for k, v in palette}
-
-    def query_index(pixel):
-        idx = palmap.get(pixel)
-        if idx:
-            return palette[idx][1], palette[idx][0]
-        dsts = [(idx, distance(pixel, color), color) for color, idx in palette]
-        mdst = min(dsts, key=tuple_value)
-        #print 'pixel =', pixel, ' distances =', dsts, ' min =', mdst
-        palmap[pixel] = mdst[0]
-        return mdst[0], mdst[2]
+def create_palette_table(palette, has_transparency):
+    """Output index of the nearest palette entry for each of the 512 9-bit colours.
+
+    Downsampled pixels are looked up with color_code(r, g, b).
+    """
+    if np is not None and palette:
+        codes = np.arange(512)
+        grid = np.stack((codes >> 6 << 5, (codes >> 3 & 7) << 5, (codes & 7) << 5), axis=-1)
+        colors = np.array([color for color, _ in palette], np.int32).reshape(-1, 3)
+        indices = np.array([idx for _, idx in palette], np.int32)
+        delta = grid[:, None, :] - colors[None, :, :]
+        # argmin returns the first nearest entry, as the loop below does
+        nearest = indices[(delta * delta).sum(axis=-1).argmin(axis=1)]
+        return (nearest + has_transparency).tolist()
+
+    table = []
+    for code in range(512):
+        color1 = code_color(code)
+        # first nearest entry wins
+        best, nearest = None, 0
+        for color, idx in palette:
+            dist = distance_sq(color1, color)
+            if best is None or dist < best:
+                best, nearest = dist, idx
+        table.append(nearest + has_transparency)
+    return table
+
+
+def color_code(r, g, b):
+    """9-bit colour code of a downsampled pixel, index into create_palette_table()."""
+    return (r >> 5) << 6 | (g >> 5) << 3 | b >> 5
+
+
+def code_color(code):
+    """Downsampled (r, g, b) of a 9-bit colour code; inverse of color_code()."""
+    return ((code >> 6) << 5, ((code >> 3) & 7) << 5, (code & 7) << 5)
+
+
+class PixelBuffer:
+    """Whole drawable contents fetched at once through a pixel region"""
+    def __init__(self, drawable, dirty=True):
+        self.drawable = drawable
+        self.width, self.height, self.bpp = drawable.width, drawable.height, drawable.bpp
+        # a clean (read-only) region must not be flushed
+        self.region = drawable.get_pixel_rgn(0, 0, self.width, self.height, dirty, False)
+        tmp = self.region[0:self.width, 0:self.height]
+        if np is not None:
+            # (height, width, bpp) array, rows are contiguous
+            self.pixels = np.frombuffer(tmp, dtype=np.uint8).reshape(self.height, self.width, self.bpp).copy()
+        else:
+            self.pixels = bytearray(tmp)
+
+    def get_row(self, y):
+        """Return line y as a flat list of channel values."""
+        if np is not None:
+            return self.pixels[y].ravel().tolist()
+        pos = self.width * self.bpp * y
+        return list(self.pixels[pos:pos + self.width * self.bpp])
+
+    def set_row(self, y, row):
+        if np is not None:
+            self.pixels[y] = np.reshape(row, (self.width, self.bpp))
+        else:
+            pos = self.width * self.bpp * y
+            self.pixels[pos:pos + self.width * self.bpp] = bytearray(row)
 
-    return query_index
+    def flush(self):
+        """Write buffer back into the drawable."""
+        if np is not None:
+            self.region[0:self.width, 0:self.height] = self.pixels.tobytes()
+        else:
+            self.region[0:self.width, 0:self.height] = bytes(self.pixels)
+        self.drawable.flush()
+        self.drawable.update(0, 0, self.width, self.height)
 
 
 class ImagePlugin:
@@ -60,50 +151,67 @@ class ImagePlugin:
         self.type = gimpfu.pdb.gimp_image_base_type(image);
         self.has_transparency = has_transparency
         if self.type == RGB:
-            drawable = gimpfu.pdb.gimp_image_active_drawable(image)
-            nchannels, _ = gimpfu.pdb.gimp_drawable_get_pixel(drawable, 0, 0)
-            def downsampling(self, pixel):
-                r = int(round(float(pixel[0]) / 0xff * 7)) << 5
-                g = int(round(float(pixel[1]) / 0xff * 7)) << 5
-                b = int(round(float(pixel[2]) / 0xff * 7)) << 5
-                return (r, g, b, 255)
+            # Pixel helpers take a flat row of channel values and the position of
+            # the pixel in it, so scalar loops need not slice pixels into tuples.
+            def downsampling(row, pos=0):
+                return (LEVELS[row[pos]], LEVELS[row[pos + 1]], LEVELS[row[pos + 2]], 255)
             # downsampling defined only for RGB* mode
             self.downsampling = downsampling
             if trans_color:
                 self.trans_color = trans_color[0:4] if self.has_transparency else False
-                def is_transparent(self, pixel):
-                    return pixel[0:3] == self.trans_color[0:3] or pixel[3] == 0
+                trans_r, trans_g, trans_b = [int(v) for v in self.trans_color[0:3]]
+                # RGB of trans_color as the low 24 bits of a little-endian RGBA word
+                trans_code = trans_r | trans_g << 8 | trans_b << 16
+                def is_transparent(row, pos=0):
+                    return (row[pos + 3] == 0 or
+                            row[pos] == trans_r and row[pos + 1] == trans_g and row[pos + 2] == trans_b)
+                def transparent_mask(rgba):
+                    # one 32-bit word per pixel: colour match and zero alpha in two compares
+                    words = np.ascontiguousarray(rgba).view('<u4')[..., 0]
+                    return ((words & 0xffffff) == trans_code) | (words <= 0xffffff)
             else:
                 # default to "invisible black"
                 self.trans_color = (0, 0, 0, 0) if self.has_transparency else False
-                def is_transparent(self, pixel):
+                def is_transparent(row, pos=0):
                     # is alpha channel completely transparent?
-                    return pixel[3] == 0
+                    return row[pos + 3] == 0
+                def transparent_mask(rgba):
+                    return rgba[..., 3] == 0
             self.is_transparent = is_transparent
+            # vectorized is_transparent over a (height, width, 4) array, NumPy only
+            self.transparent_mask = transparent_mask
 
-        elif type_ == INDEXED:
-            trans_index = False
+        elif self.type == INDEXED:
+            trans_index = None
             trans_count = 0
             num_bytes, colormap = gimpfu.pdb.gimp_image_get_colormap(image)
-            for i, c in enumerate(range(0, num_bytes, 3)):
-                if (colormap[c], colormap[c + 1], colormap[c + 2]) == trans_color:
-                    trans_index = i
-                    trans_count += 1
+            if trans_color:
+                for i, c in enumerate(range(0, num_bytes, 3)):
+                    if (colormap[c], colormap[c + 1], colormap[c + 2]) == tuple(trans_color[0:3]):
+                        trans_index = i
+                        trans_count += 1
             if trans_count > 1:
                 # Is it possible to register same color twice in colormap?
                 raise Exception("More than one transparent color detected.")
             # Use index of transparent color
             self.trans_color = trans_index
-            def is_transparent(self, pixel):
-                return self.has_transparency and pixel == trans_index
+            def is_transparent(row, pos=0):
+                # pixel is (index, alpha)
+                return has_transparency and (row[pos] == trans_index or row[pos + 1] == 0)
+            def transparent_mask(pixels):
+                if not has_transparency:
+                    return np.zeros(pixels.shape[0:2], dtype=bool)
+                return (pixels[..., 0] == trans_index) | (pixels[..., 1] == 0)
             self.is_transparent = is_transparent
+            # vectorized is_transparent over a (height, width, 2) array, NumPy only
+            self.transparent_mask = transparent_mask
 
 
 def check_params(image, filename, folder, image_enc, exp_pal, exp_ptp):
     drawable = gimpfu.pdb.gimp_image_active_drawable(image)
 
-    # In screen 5 only even sizes are permitted.
-    width, height = gimpfu.pdb.gimp_drawable_width(drawable) & ~1, gimpfu.pdb.gimp_drawable_height(drawable) & ~1
+    # Limits apply to the real size: the encoder packs every row, odd ones included.
+    width, height = gimpfu.pdb.gimp_drawable_width(drawable), gimpfu.pdb.gimp_drawable_height(drawable)
 
     errors = []
     if image_enc != 'no-output':
@@ -116,8 +224,13 @@ def check_params(image, filename, folder, image_enc, exp_pal, exp_ptp):
             if height > MAX_DAT_HEIGHT:
                 errors.append('Drawable height must be less than or equal to %i.' % MAX_DAT_HEIGHT)
 
-        elif width != MAX_WIDTH:
-            errors.append('Drawable width must be %i.' % MAX_WIDTH)
+        else:
+            if width != MAX_WIDTH:
+                errors.append('Drawable width must be %i.' % MAX_WIDTH)
+            # SC5, SR5 and RAW hold a single page: the buffer is one page long
+            # and the SC5 palette sits at its end.
+            if height > MAX_HEIGHT:
+                errors.append('Drawable height must be less than or equal to %i.' % MAX_HEIGHT)
 
     if exp_pal and os.path.exists(os.path.join(folder, '%s.PAL' % filename)):
         errors.append('Output palette "%s.PAL" file already exists.' % filename)
@@ -145,7 +258,7 @@ def write_gr4_alpha(image, layer, filename, folder, dithering, exp_pal, image_en
     @param layer: gimp layer (or drawable)
     @param filename: file name
     @param folder: output directory
-    @param dithering: whether dithering is active
+    @param dithering: dithering method (none, error diffusion or ordered)
     @param exp_pal: export palette data too
     @param image_enc: output encoding
     @param exp_ptp: export plain-text-palette data too
@@ -161,7 +274,7 @@ def write_gr4(image, layer, filename, folder, dithering, exp_pal, has_transparen
     @param layer: gimp layer (or drawable)
     @param filename: file name
     @param folder: output directory
-    @param dithering: whether dithering is active
+    @param dithering: dithering method (none, error diffusion or ordered)
     @param exp_pal: export palette data too
     @param has_transparency: transparency support consumes color index 0
     @param trans_color: RGB components of input color to be considered transparency
@@ -179,52 +292,82 @@ def write_gr4(image, layer, filename, folder, dithering, exp_pal, has_transparen
 
     filename = filename.upper()
 
-    # Create temporary image with alpha channel
-    new_image = gimpfu.pdb.gimp_image_duplicate(image)
-    if not new_image.layers[0].has_alpha:
-        new_image.layers[0].add_alpha()
-    drawable = gimpfu.pdb.gimp_image_active_drawable(new_image)
+    drawable = gimpfu.pdb.gimp_image_active_drawable(image)
+    if image_enc != 'no-output' and drawable.has_alpha and gimpfu.pdb.gimp_image_base_type(image) == RGB:
+        # Nothing to convert and nothing to show: pixels are only read, so
+        # the image can be used as it is.
+        new_image = None
+        work_image = image
+    else:
+        # Create temporary image with alpha channel
+        new_image = work_image = gimpfu.pdb.gimp_image_duplicate(image)
+        if not new_image.layers[0].has_alpha:
+            new_image.layers[0].add_alpha()
+        drawable = gimpfu.pdb.gimp_image_active_drawable(new_image)
     width, height = gimpfu.pdb.gimp_drawable_width(drawable), gimpfu.pdb.gimp_drawable_height(drawable)
 
     # Check if image is indexed and convert to RGB if necessary.
     palette = []
     max_colors = MAX_COLORS - has_transparency
-    type_ = gimpfu.pdb.gimp_image_base_type(new_image);
+    type_ = gimpfu.pdb.gimp_image_base_type(work_image);
     if type_ == INDEXED:
-        num_bytes, colormap = gimpfu.pdb.gimp_image_get_colormap(new_image)
+        num_bytes, colormap = gimpfu.pdb.gimp_image_get_colormap(work_image)
         # Convert to RGB to reduce color count. Old palette is discarded.
-        if num_bytes // 3 > max_colors or dithering:
+        if num_bytes // 3 > max_colors or dithering != NO_DITHERING:
             type_ = RGB
             palette = []
             gimpfu.pdb.gimp_image_convert_rgb(new_image);
+        else:
+            # Colormap fits already: use it as palette and keep pixel indices as they are.
+            palette = [(tuple(LEVELS[v] for v in colormap[c:c + 3]), i)
+                       for i, c in enumerate(range(0, num_bytes, 3))]
     elif type_ == GRAY:
         type_ = RGB
         gimpfu.pdb.gimp_image_convert_rgb(new_image);
 
+    # Fetch all pixels at once instead of querying them one by one.
+    pixels = PixelBuffer(drawable, new_image is not None)
+
     try:
-        plugin = ImagePlugin(new_image, has_transparency, trans_color)
+        plugin = ImagePlugin(work_image, has_transparency, trans_color)
     except Exception as e:
         gimp.message(e.args[0])
-        gimp.delete(new_image)
+        if new_image is not None:
+            gimp.delete(new_image)
         return
 
+    if palette and not has_transparency:
+        # Indexed pixels pass through as they are: like RGB images, they may
+        # only be transparent when index 0 is reserved for it.
+        if np is not None:
+            hidden = bool((pixels.pixels[..., 1] == 0).any())
+        else:
+            hidden = 0 in pixels.pixels[1::2]
+        if hidden:
+            gimp.message('Wrong plugin: alpha channel is being used.')
+            if new_image is not None:
+                gimp.delete(new_image)
+            return
+
     # create palette data
-    pal9bits = [0] * 2 * MAX_COLORS
+    pal9bits = bytearray(2 * MAX_COLORS)
     txtpal = [(0, 0, 0)] * MAX_COLORS
 
     if not palette:
-        # disable dithering when transparency is used
-        use_transparency = check_transparency(plugin, new_image)
+        # disable error diffusion when transparency is used; otherwise the
+        # answer does not matter, so skip the extra pass over the image
+        use_transparency = dithering == ERROR_DIFFUSION and check_transparency(plugin, pixels)
         try:
-            drawable = downsampling(plugin, new_image, use_transparency, dithering)
+            pixels = downsampling(plugin, pixels, use_transparency, dithering)
         except TypeError:
             gimp.message('Wrong plugin: alpha channel is being used.')
-            gimp.delete(new_image)
+            if new_image is not None:
+                gimp.delete(new_image)
             return
         #gimpfu.pdb.gimp_display_new(new_image) # disply downsampled image
-        histogram = create_histogram(plugin, drawable)
+        histogram = create_histogram(plugin, pixels)
         palette = quantize_colors(histogram, max_colors)
-        query = create_distance_query(palette)
+        table = create_palette_table(palette, has_transparency)
 
     for (r, g, b), index in palette:
         # Start palette at color 1 if transparency is set.
@@ -234,215 +377,418 @@ def write_gr4(image, layer, filename, folder, dithering, exp_pal, has_transparen
         txtpal[i] = (r >> 5, g >> 5, b >> 5)
 
     if exp_ptp:
+        lines = ['SCREEN 5 palette:']
+        lines.extend('%i: %i, %i, %i' % (i, r, g, b) for i, (r, g, b) in enumerate(txtpal))
         file = open(os.path.join(folder, '%s.TXT' % filename), 'wt')
-        print >>file, 'SCREEN 5 palette:'
-        i = 0
-        for (r, g, b) in txtpal:
-            print >>file, '%i: %i, %i, %i' % (i, r, g, b)
-            i += 1
+        file.write('\n'.join(lines) + '\n')
         file.close()
 
     if exp_pal:
-        encoded = struct.pack('<BHHH{}B'.format(len(pal9bits)), BIN_PREFIX, PALETTE_OFFSET,
-                PALETTE_OFFSET + len(pal9bits), 0, *pal9bits[0:len(pal9bits)])
+        header = BIN_HEADER.pack(BIN_PREFIX, PALETTE_OFFSET, PALETTE_OFFSET + len(pal9bits), 0)
         file = open(os.path.join(folder, '%s.PAL' % filename), 'wb')
-        file.write(encoded)
+        file.write(header)
+        file.write(pal9bits)
         file.close()
 
     gimpfu.pdb.gimp_progress_init('Exporting image to %s format...' % image_enc, None)
     gimpfu.pdb.gimp_progress_update(0)
 
-    # buffer = [0] * (MAX_WIDTH // 2) * MAX_HEIGHT
+    # one byte per two pixels, zero-filled
     if image_enc == 'DAT':
-        buffer = [0] * (width // 2) * height
+        buffer = bytearray((width * height + 1) // 2)
     else:
-        buffer = [0] * (MAX_WIDTH // 2) * MAX_HEIGHT
+        buffer = bytearray((MAX_WIDTH // 2) * MAX_HEIGHT)
 
-    step = 1.0 / height
-    percent = 0.0
+    stride = max(1, height // PROGRESS_UPDATES)
 
-    if image_enc != 'no-output':
-        for y in range(0, height):
-            for x in range(0, width):
-                if type_ == RGB:
-                    # num_channels, RGBA
-                    _, c = gimpfu.pdb.gimp_drawable_get_pixel(drawable, x, y)
-                    if plugin.is_transparent(plugin, c):
-                        # index of transparent color is always 0
-                        index = 0
-                    else:
-                        index, _ = query((c[0], c[1], c[2]))
-                        index += has_transparency
-                else:
-                    # num_channels, index, alpha
-                    _, (index, _) = gimpfu.pdb.gimp_drawable_get_pixel(drawable, x, y)
-                    index += has_transparency
-                pos = x // 2 + y * (width // 2)
-                buffer[pos] |= index if x % 2 else index << 4;
-
-            percent += step
-            gimpfu.pdb.gimp_progress_update(percent)
-
-        # Embed palette into image data (SC5 only)
-        if image_enc == 'SC5':
-            for pos in range(32):
-                buffer[0x7680 + pos] = pal9bits[pos]
-
-        if image_enc == 'RAW':
-            encoded = struct.pack('<{}B'.format(len(buffer)), *buffer)
-        elif image_enc == 'DAT':
-            encoded = struct.pack('<HH{}B'.format(width * height // 2), width, height, *buffer)
+    if image_enc == 'no-output':
+        pixels.flush()
+        gimpfu.pdb.gimp_display_new(new_image)
+        return
+
+    if np is not None:
+        if type_ == RGB:
+            # one table lookup per pixel
+            rgb = pixels.pixels[..., 0:3].astype(np.intp)
+            indices = np.array(table, dtype=np.uint8)[color_code(rgb[..., 0], rgb[..., 1], rgb[..., 2])]
         else:
-            encoded = struct.pack('<BHHH{}B'.format(len(buffer)), BIN_PREFIX, 0, len(buffer), 0, *buffer)
-        file = open(os.path.join(folder, '%s.%s' % (filename, image_enc)), 'wb')
-        file.write(encoded)
-        file.close()
-        gimp.delete(new_image)
+            # index, alpha
+            indices = pixels.pixels[..., 0] + int(has_transparency)
+        if has_transparency:
+            # index of transparent color is always 0
+            indices[plugin.transparent_mask(pixels.pixels)] = 0
+
+        # Pixels are stored as consecutive nibbles, two per byte.
+        flat = indices.ravel()
+        if flat.size % 2:
+            flat = np.append(flat, 0)
+        packed = (flat[0::2] << 4) | flat[1::2]
+        # never grow the buffer past its page
+        buffer[0:packed.size] = packed[0:len(buffer)].astype(np.uint8).tobytes()
+        gimpfu.pdb.gimp_progress_update(1.0)
+
     else:
-        gimpfu.pdb.gimp_display_new(new_image)
+        bpp = pixels.bpp
+        pos = 0
+        # indices not packed yet; one may carry over after an odd-sized line (DAT)
+        line = []
+        # local names save attribute lookups in the per-pixel loop
+        get_row, is_transparent = pixels.get_row, plugin.is_transparent
+        progress = gimpfu.pdb.gimp_progress_update
+        # Pick the per-line conversion once instead of testing the image type on every pixel.
+        # Index of transparent color is always 0.
+        if type_ == RGB:
+            def line_indices(row):
+                # RGBA
+                return [0 if is_transparent(row, i) else table[color_code(row[i], row[i + 1], row[i + 2])]
+                        for i in range(0, width * bpp, bpp)]
+        elif has_transparency:
+            def line_indices(row):
+                # index, alpha
+                return [0 if is_transparent(row, i) else row[i] + has_transparency
+                        for i in range(0, width * bpp, bpp)]
+        else:
+            def line_indices(row):
+                # index, alpha; nothing is transparent, indices pass through
+                return row[0:width * bpp:bpp]
 
+        for y in range(0, height):
+            line.extend(line_indices(get_row(y)))
+
+            # Pair indices two by two, high nibble first.
+            n = len(line) & ~1
+            packed = [(hi << 4) | lo for hi, lo in zip(line[0:n:2], line[1:n:2])][0:len(buffer) - pos]
+            buffer[pos:pos + len(packed)] = packed
+            pos += len(packed)
+            del line[0:n]
+
+            if y % stride == 0:
+                progress(float(y) / height)
+
+        if line and pos < len(buffer):
+            buffer[pos] = line[0] << 4
+
+    # Embed palette into image data (SC5 only)
+    if image_enc == 'SC5':
+        buffer[0x7680:0x7680 + 32] = pal9bits[0:32]
+
+    # Header and image data are written separately, no concatenated copy.
+    if image_enc == 'RAW':
+        header = b''
+    elif image_enc == 'DAT':
+        header = DAT_HEADER.pack(width, height)
+    else:
+        header = BIN_HEADER.pack(BIN_PREFIX, 0, len(buffer), 0)
+    file = open(os.path.join(folder, '%s.%s' % (filename, image_enc)), 'wb')
+    file.write(header)
+    file.write(buffer)
+    file.close()
+    if new_image is not None:
+        gimp.delete(new_image)
 
-def check_transparency(plugin, image):
+
+def check_transparency(plugin, pixels):
     if not plugin.has_transparency:
         return False
 
-    drawable = gimpfu.pdb.gimp_image_active_drawable(image)
-    width, height = gimpfu.pdb.gimp_drawable_width(drawable), gimpfu.pdb.gimp_drawable_height(drawable)
+    width, height = pixels.width, pixels.height
 
-    percent = 0.0
     gimpfu.pdb.gimp_progress_init('Checking image alpha channel...', None)
-    gimpfu.pdb.gimp_progress_update(percent)
-    step = 1.0 / height
+    gimpfu.pdb.gimp_progress_update(0.0)
+    stride = max(1, height // PROGRESS_UPDATES)
 
+    if np is not None:
+        found = bool(plugin.transparent_mask(pixels.pixels).any())
+        gimpfu.pdb.gimp_progress_update(1.0)
+        return found
+
+    bpp = pixels.bpp
+    get_row, is_transparent = pixels.get_row, plugin.is_transparent
+    progress = gimpfu.pdb.gimp_progress_update
     for y in range(height):
-        for x in range(width):
-            _, c = gimpfu.pdb.gimp_drawable_get_pixel(drawable, x, y)
-            if plugin.is_transparent(plugin, c):
+        row = get_row(y)
+        for pos in range(0, width * bpp, bpp):
+            if is_transparent(row, pos):
                 return True
-        percent += step
-        gimpfu.pdb.gimp_progress_update(percent)
+        if y % stride == 0:
+            progress(float(y) / height)
 
     return False
 
 
-def create_histogram(plugin, drawable):
-    width, height = gimpfu.pdb.gimp_drawable_width(drawable), gimpfu.pdb.gimp_drawable_height(drawable)
-    histogram = {}
+def create_histogram(plugin, pixels):
+    width, height = pixels.width, pixels.height
+    histogram = Counter()
 
-    percent = 0.0
-    step = 1.0 / height
+    stride = max(1, height // PROGRESS_UPDATES)
 
     gimpfu.pdb.gimp_progress_init('Creating histogram...', None)
     gimpfu.pdb.gimp_progress_update(0)
 
+    if np is not None:
+        # Pixels are downsampled already: count their 9-bit colour codes in a
+        # dense 512-bin histogram, which is in (r, g, b) order as well.
+        if plugin.has_transparency:
+            rgb = pixels.pixels[~plugin.transparent_mask(pixels.pixels)][:, 0:3].astype(np.intp)
+        else:
+            # downsampling left no transparent pixels behind, nothing to mask
+            rgb = pixels.pixels.reshape(-1, pixels.bpp)[:, 0:3].astype(np.intp)
+        counts = np.bincount(color_code(rgb[:, 0], rgb[:, 1], rgb[:, 2]), minlength=512)
+        gimpfu.pdb.gimp_progress_update(1.0)
+        return [(code_color(code), n) for code, n in enumerate(counts.tolist()) if n]
+
+    bpp = pixels.bpp
+    get_row, is_transparent, update = pixels.get_row, plugin.is_transparent, histogram.update
+    progress = gimpfu.pdb.gimp_progress_update
     for y in range(height):
-        for x in range(width):
-            _, c = gimpfu.pdb.gimp_drawable_get_pixel(drawable, x, y)
-            if plugin.is_transparent(plugin, c):
-                continue
-            histogram[(c[0], c[1], c[2])] = histogram.get((c[0], c[1], c[2]), 0) + 1
+        row = get_row(y)
+        # count 9-bit colour codes, as the NumPy path does
+        update(color_code(row[pos], row[pos + 1], row[pos + 2])
+               for pos in range(0, width * bpp, bpp) if not is_transparent(row, pos))
 
-        percent += step
-        gimpfu.pdb.gimp_progress_update(percent)
+        if y % stride == 0:
+            progress(float(y) / height)
 
-    return histogram.items()
+    # same (r, g, b) order as the NumPy path
+    return [(code_color(code), n) for code, n in sorted(histogram.items())]
 
 
-def distance(src, dst):
+def distance_sq(src, dst):
+    """Squared euclidean distance; callers only compare distances, so no sqrt."""
     r1, g1, b1 = src
     r2, g2, b2 = dst
 
-    return sqrt(
-        (r1 - r2) ** 2 + (g1 - g2) ** 2 + (b1 - b2) ** 2
-    )
+    dr, dg, db = r1 - r2, g1 - g2, b1 - b2
+    return dr * dr + dg * dg + db * db
 
 
 def quantize_colors(histogram, length):
     """Group similar colours reducing palette to "length"."""
     palette = []
 
+    if len(histogram) <= length:
+        # Already few enough colours (e.g. pixel art): nothing to merge or refine.
+        for index, (color, _) in enumerate(sorted(histogram)):
+            palette.append((color, index))
+        return palette
+
     gimpfu.pdb.gimp_progress_init('Quantizing colors...', None)
     gimpfu.pdb.gimp_progress_update(0.0)
 
-    percent = 0.0
-    step = float(len(histogram) - length) / 100
-
-    while len(histogram) > length:
-        # Order histogram by color usage (this is slooooooow!)
-        histogram.sort(key=tuple_value)
+    colors = [color for color, _ in histogram]
+    freqs = [freq for _, freq in histogram]
+    remaining = set(range(len(colors)))
+
+    # Least frequent colour on top, ties broken by histogram order. Merged
+    # colours are pushed again with their new frequency; the old entries
+    # become stale and are skipped.
+    heap = [(freq, idx) for idx, freq in enumerate(freqs)]
+    heapq.heapify(heap)
+
+    if np is not None:
+        # Colours are already reduced to 9 bits, so there are at most 512 of
+        # them: all pairwise distances fit in a small matrix computed once.
+        rgb = np.array(colors, dtype=np.int32).reshape(-1, 3)
+        delta = rgb[:, None, :] - rgb[None, :, :]
+        distances = (delta * delta).sum(axis=-1)
+        alive = np.ones(len(colors), dtype=bool)
+        farthest = np.iinfo(distances.dtype).max
+
+    merges = max(1, len(colors) - length)
+    stride = max(1, merges // PROGRESS_UPDATES)
+    merged = 0
+    progress = gimpfu.pdb.gimp_progress_update
+
+    while len(remaining) > length:
+        freq, idx = heapq.heappop(heap)
+        if freq != freqs[idx] or idx not in remaining:
+            continue
 
         # Get least frequent item and its nearest cousin by colour
-        color1, freq = histogram.pop(0)
-        distances = [
-            (idx, distance(color1, color2)) for idx, (color2, _) in enumerate(histogram[1:], start=1)
-        ]
-        index, _ = min(distances, key=tuple_value)
+        remaining.remove(idx)
+        if np is not None:
+            alive[idx] = False
+            dist = np.where(alive, distances[idx], farthest)
+            # equally near colours: least frequent, then lowest index
+            ties = np.flatnonzero(dist == dist.min()).tolist()
+            nearest = min(ties, key=lambda other: (freqs[other], other))
+        else:
+            color1 = colors[idx]
+            nearest = min(remaining, key=lambda other: (distance_sq(color1, colors[other]), freqs[other], other))
 
         # add removed item's frequency into nearest cousin's frequency
-        histogram[index] = (histogram[index][0], histogram[index][1] + freq)
+        freqs[nearest] += freq
+        heapq.heappush(heap, (freqs[nearest], nearest))
 
-        percent += step
-        gimpfu.pdb.gimp_progress_update(percent)
+        merged += 1
+        if merged % stride == 0:
+            progress(float(merged) / merges)
 
-    for index, (color, _) in enumerate(sorted(histogram, key=tuple_key)):
+    centers = refine_palette(histogram, [colors[idx] for idx in remaining])
+
+    for index, color in enumerate(sorted(centers)):
         palette.append((color, index))
 
     return palette
 
 
-def scatter_noise(drawable, x, y, error):
-    NEIGHBORS = ( (+1, 0, 7.0/16), (-1, +1, 3.0/16), (-1, +1, 5.0/16), (+1, +1, 1.0/16) )
-    width, height = gimpfu.pdb.gimp_drawable_width(drawable), gimpfu.pdb.gimp_drawable_height(drawable)
-
-    for offset_x, offset_y, debt in NEIGHBORS:
-        try:
-            off_x, off_y = x + offset_x, y + offset_y
-
-            if off_x < 0 or off_y < 0 or off_x >= width or off_y >= height:
+def refine_palette(histogram, centers, iterations=KMEANS_ITERATIONS):
+    """Move palette colours to the weighted mean of the colours they represent (k-means).
+
+    Means are rounded to the 9-bit grid; a centre whose rounded mean is
+    already taken by another centre stays where it is.
+    """
+    centers = list(centers)
+    if np is not None:
+        points = np.array([color for color, _ in histogram], np.int32)
+    assignment = None
+    for _ in range(iterations):
+        # nearest centre of every histogram colour, first one wins ties
+        if np is not None:
+            delta = points[:, None, :] - np.array(centers, np.int32)[None, :, :]
+            nearest = (delta * delta).sum(axis=2).argmin(axis=1).tolist()
+        else:
+            nearest = []
+            for color, _ in histogram:
+                best, found = None, 0
+                for i, center in enumerate(centers):
+                    dist = distance_sq(color, center)
+                    if best is None or dist < best:
+                        best, found = dist, i
+                nearest.append(found)
+        if nearest == assignment:
+            break
+        assignment = nearest
+
+        sums = [[0, 0, 0, 0] for _ in centers]
+        for (color, freq), i in zip(histogram, assignment):
+            total = sums[i]
+            total[0] += color[0] * freq
+            total[1] += color[1] * freq
+            total[2] += color[2] * freq
+            total[3] += freq
+
+        for i, (r, g, b, weight) in enumerate(sums):
+            if not weight:
                 continue
+            # round to the nearest multiple of 32, as downsampling does
+            moved = tuple(min(7, (v + 16 * weight) // (32 * weight)) << 5 for v in (r, g, b))
+            if moved not in centers:
+                centers[i] = moved
 
-            nchannels, pixel = gimpfu.pdb.gimp_drawable_get_pixel(drawable, off_x, off_y)
-            npixel = tuple(max(0, min(255, round(color + error * debt))) for color, error in zip(pixel, error))
-            #print 'pos:', (off_x + 255 * off_y), " pixel/npixel:", pixel, npixel
-            gimpfu.pdb.gimp_drawable_set_pixel(drawable, off_x, off_y, nchannels, npixel)
+    return centers
 
-        except Exception:
-            pass # hey, gimp developers, Python 2.7 sucks!
 
+def scatter_noise(rows, x, error, width, bpp):
+    """Floyd-Steinberg: spread error of pixel x in rows[0] over its neighbours.
 
-def downsampling(plugin, image, use_transparent = False, dithering = True):
-    """Reduction to 9-bit palette with optional dithering."""
-    drawable = gimpfu.pdb.gimp_image_active_drawable(image)
-    width, height = gimpfu.pdb.gimp_drawable_width(drawable), gimpfu.pdb.gimp_drawable_height(drawable)
+    rows holds the current line and, if any, the line below it as flat lists
+    of channel values.
+    """
+    NEIGHBORS = ( (+1, 0, 7.0/16), (-1, +1, 3.0/16), (0, +1, 5.0/16), (+1, +1, 1.0/16) )
+
+    er, eg, eb = error
+    below = len(rows) > 1
+    for offset_x, offset_y, debt in NEIGHBORS:
+        off_x = x + offset_x
+        if off_x < 0 or off_x >= width or (offset_y and not below):
+            continue
+
+        line = rows[offset_y]
+        pos = off_x * bpp
+        # channels unrolled, clamped to 0..255
+        r = int(round(line[pos] + er * debt))
+        g = int(round(line[pos + 1] + eg * debt))
+        b = int(round(line[pos + 2] + eb * debt))
+        line[pos] = 0 if r < 0 else 255 if r > 255 else r
+        line[pos + 1] = 0 if g < 0 else 255 if g > 255 else g
+        line[pos + 2] = 0 if b < 0 else 255 if b > 255 else b
+
+
+def downsampling(plugin, pixels, use_transparent = False, dithering = ERROR_DIFFUSION):
+    """Reduction to 9-bit palette with optional dithering.
+
+    Ordered dithering only offsets each pixel by its place in BAYER_OFFSETS,
+    so unlike error diffusion it needs no pass over neighbouring pixels.
+    """
+    width, height = pixels.width, pixels.height
  
-    # Disable dithering if transparent color is used
-    dithering = not use_transparent and dithering
+    # Disable error diffusion if transparent color is used
+    if use_transparent and dithering == ERROR_DIFFUSION:
+        dithering = NO_DITHERING
 
     # Update progress bar
-    gimpfu.pdb.gimp_progress_init('Downsampling%s...' % (' with dithering (slow!)' if dithering else ''), None)
+    if dithering == ORDERED_DITHERING:
+        method = ' with ordered dithering'
+    elif dithering == ERROR_DIFFUSION:
+        method = ' with dithering (slow!)'
+    else:
+        method = ''
+    gimpfu.pdb.gimp_progress_init('Downsampling%s...' % method, None)
     gimpfu.pdb.gimp_progress_update(0.0)
 
-    percent = 0.0
-    step = 1.0 / height
-
+    if np is not None and dithering in (NO_DITHERING, ORDERED_DITHERING):
+        # Same LEVELS table as plugin.downsampling, applied to the whole image at once.
+        rgba = pixels.pixels
+        mask = plugin.transparent_mask(rgba)
+        rgb = rgba[..., 0:3]
+        if dithering == ORDERED_DITHERING:
+            offsets = np.tile(np.array(BAYER_OFFSETS, dtype=np.int16), (height // 8 + 1, width // 8 + 1))
+            rgb = np.clip(rgb + offsets[0:height, 0:width, None], 0, 255)
+        rgba[..., 0:3] = np.array(LEVELS, dtype=np.uint8)[rgb]
+        rgba[..., 3] = 255
+        if mask.any():
+            rgba[mask] = tuple(plugin.trans_color)
+        gimpfu.pdb.gimp_progress_update(1.0)
+        return pixels
+
+    stride = max(1, height // PROGRESS_UPDATES)
+    bpp = pixels.bpp
+
+    get_row, is_transparent, downsample = pixels.get_row, plugin.is_transparent, plugin.downsampling
+    trans_color = plugin.trans_color
+    progress = gimpfu.pdb.gimp_progress_update
+    ordered = dithering == ORDERED_DITHERING
+    diffusion = dithering == ERROR_DIFFUSION
+
+    # Work on plain lists, one line (plus the line below it) at a time.
+    below = get_row(0)
     for y in range(height):
+        row = below
+        if y + 1 < height:
+            below = get_row(y + 1)
+            rows = (row, below)
+        else:
+            rows = (row,)
+        thresholds = BAYER_OFFSETS[y & 7]
+
         for x in range(width):
-            nchannels, c = gimpfu.pdb.gimp_drawable_get_pixel(drawable, x, y)
-            if plugin.is_transparent(plugin, c):
-                d = plugin.trans_color
+            pos = x * bpp
+            r, g, b = row[pos], row[pos + 1], row[pos + 2]
+            if is_transparent(row, pos):
+                d = trans_color
+            elif ordered:
+                offset = thresholds[x & 7]
+                row[pos] = min(255, max(0, r + offset))
+                row[pos + 1] = min(255, max(0, g + offset))
+                row[pos + 2] = min(255, max(0, b + offset))
+                d = downsample(row, pos)
             else:
-                d = plugin.downsampling(plugin, c)
-            gimpfu.pdb.gimp_drawable_set_pixel(drawable, x, y, nchannels, d)
+                d = downsample(row, pos)
+            row[pos:pos + len(d)] = d
 
-            if dithering:
-                # ignore alpha channel in c and d
-                error = [old - new for old, new in zip(c[0:3], d[0:3])]
-                scatter_noise(drawable, x, y, error)
+            if diffusion:
+                # ignore alpha channel
+                er, eg, eb = r - d[0], g - d[1], b - d[2]
+                # colours already on the 9-bit grid leave nothing to spread
+                if er or eg or eb:
+                    scatter_noise(rows, x, (er, eg, eb), width, bpp)
 
-        percent += step
-        gimpfu.pdb.gimp_progress_update(percent)
+        pixels.set_row(y, row)
+        if y % stride == 0:
+            progress(float(y) / height)
 
-    return drawable
+    return pixels
 
 
 gimpfu.register("msx_gr4_exporter",
@@ -453,7 +799,8 @@ gimpfu.register("msx_gr4_exporter",
                 "RGB*, INDEXED*, GRAY*", [
                     (gimpfu.PF_STRING, "filename", "File name", DEFAULT_FILENAME),
                     (gimpfu.PF_DIRNAME, "folder", "Output Folder", DEFAULT_OUTPUT_DIR),
-                    (gimpfu.PF_BOOL, "dithering", "Dithering", True),
+                    (gimpfu.PF_OPTION, "dithering", "Dithering", ERROR_DIFFUSION,
+                       ("None", "Floyd-Steinberg", "Ordered (Bayer 8x8)")),
                     (gimpfu.PF_BOOL, "exp-pal", "Export palette", False),
                     (gimpfu.PF_BOOL, "has_transparency", "Reserve index 0 as transparency", True),
                     (gimpfu.PF_COLOR, "trans_color", "Input transparent color", (0xff, 0x0, 0xff)),
@@ -476,7 +823,8 @@ gimpfu.register("msx_gr4_exporter_alpha",
                 "RGBA, INDEXEDA, GRAYA", [
                     (gimpfu.PF_STRING, "filename", "File name", DEFAULT_FILENAME),
                     (gimpfu.PF_DIRNAME, "folder", "Output Folder", DEFAULT_OUTPUT_DIR),
-                    (gimpfu.PF_BOOL, "dithering", "Dithering", True),
+                    (gimpfu.PF_OPTION, "dithering", "Dithering", ERROR_DIFFUSION,
+                       ("None", "Floyd-Steinberg", "Ordered (Bayer 8x8)")),
                     (gimpfu.PF_BOOL, "exp-pal", "Export palette", False),
                     (gimpfu.PF_RADIO, "image-enc", "Image Encoding", DEFAULT_OUTPUT_FMT,
                        (("Binary format with palette (SC5)", "SC5"),
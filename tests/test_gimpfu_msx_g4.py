@@ -0,0 +1,426 @@
+"""Tests of gimpfu_msx_g4, run outside GIMP.
+
+The gimpfu and gimp modules only exist inside GIMP's Python, so minimal
+stand-ins are registered before the plug-in is imported. Pixel code is
+run both with NumPy and with plugin.np set to None, the pure-Python
+fallback.
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class FakeRegion(object):
+    """Pixel region of a whole drawable, as PixelBuffer slices it."""
+    def __init__(self, drawable):
+        self.drawable = drawable
+
+    def __getitem__(self, key):
+        return bytes(self.drawable.data)
+
+    def __setitem__(self, key, value):
+        self.drawable.data = bytearray(value)
+
+
+class FakeDrawable(object):
+    def __init__(self, width, height, bpp=4, data=None):
+        self.width = width
+        self.height = height
+        self.bpp = bpp
+        self.has_alpha = bpp in (2, 4)
+        self.data = bytearray(width * height * bpp) if data is None else bytearray(data)
+
+    def get_pixel_rgn(self, x, y, width, height, dirty, shadow):
+        return FakeRegion(self)
+
+    def add_alpha(self):
+        self.has_alpha = True
+
+    def flush(self):
+        pass
+
+    def update(self, x, y, width, height):
+        pass
+
+
+class FakeImage(object):
+    def __init__(self, width, height, base_type=0, colormap=(), bpp=4, data=None):
+        self.drawable = FakeDrawable(width, height, bpp, data)
+        self.layers = [self.drawable]
+        self.base_type = base_type
+        self.colormap = list(colormap)
+
+
+class FakePDB(object):
+    def gimp_image_active_drawable(self, image):
+        return image.drawable
+
+    def gimp_drawable_width(self, drawable):
+        return drawable.width
+
+    def gimp_drawable_height(self, drawable):
+        return drawable.height
+
+    def gimp_image_base_type(self, image):
+        return image.base_type
+
+    def gimp_image_get_colormap(self, image):
+        return len(image.colormap), image.colormap
+
+    def gimp_image_duplicate(self, image):
+        # pixels are written back only for 'no-output', never here
+        return image
+
+    def gimp_progress_init(self, message, display):
+        pass
+
+    def gimp_progress_update(self, fraction):
+        pass
+
+
+messages = []
+
+gimpfu = types.ModuleType('gimpfu')
+gimpfu.pdb = FakePDB()
+gimpfu.register = lambda *args, **kwargs: None
+gimpfu.main = lambda: None
+for name in ('PF_STRING', 'PF_DIRNAME', 'PF_BOOL', 'PF_OPTION', 'PF_COLOR', 'PF_RADIO'):
+    setattr(gimpfu, name, 0)
+gimp = types.ModuleType('gimp')
+gimp.message = messages.append
+gimp.delete = lambda image: None
+sys.modules.setdefault('gimpfu', gimpfu)
+sys.modules.setdefault('gimp', gimp)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import gimpfu_msx_g4 as plugin
+
+# channel values of the 9-bit palette
+GRID = [level << 5 for level in range(8)]
+
+
+class CheckParamsTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        del messages[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def check(self, height, image_enc, width=plugin.MAX_WIDTH):
+        return plugin.check_params(FakeImage(width, height), 'NONAME', self.folder, image_enc, False, False)
+
+    def test_single_page_formats_fit(self):
+        for image_enc in ('SC5', 'SR5', 'RAW'):
+            self.assertEqual(self.check(plugin.MAX_HEIGHT, image_enc), [])
+
+    def test_single_page_formats_reject_taller_images(self):
+        # 257+ rows overflow the one-page buffer and the SC5 palette slot
+        for image_enc in ('SC5', 'SR5', 'RAW'):
+            for height in (257, 258, 300, 512, plugin.MAX_HEIGHT * plugin.MAX_PAGES):
+                errors = self.check(height, image_enc)
+                self.assertEqual(len(errors), 1, (image_enc, height, errors))
+                self.assertIn('height', errors[0])
+
+    def test_odd_width_beyond_limit_is_rejected(self):
+        # the encoder packs the real width, so 257 columns must not pass as 256
+        for image_enc in ('SC5', 'SR5', 'RAW', 'DAT'):
+            errors = self.check(100, image_enc, width=plugin.MAX_WIDTH + 1)
+            self.assertEqual(len(errors), 1, (image_enc, errors))
+            self.assertIn('width', errors[0])
+
+    def test_dat_height_limit(self):
+        self.assertEqual(self.check(plugin.MAX_DAT_HEIGHT, 'DAT'), [])
+        self.assertEqual(len(self.check(plugin.MAX_DAT_HEIGHT + 1, 'DAT')), 1)
+
+    def test_no_output_allows_all_pages(self):
+        self.assertEqual(self.check(plugin.MAX_HEIGHT * plugin.MAX_PAGES, 'no-output'), [])
+
+    def test_tall_sc5_export_writes_nothing(self):
+        plugin.write_gr4(FakeImage(plugin.MAX_WIDTH, 300), None, 'noname', self.folder,
+                         plugin.ERROR_DIFFUSION, True, True, False, 'SC5', True)
+        self.assertEqual(len(messages), 1)
+        self.assertIn('height', messages[0])
+        self.assertEqual(os.listdir(self.folder), [])
+
+
+class OrderedDitheringTest(unittest.TestCase):
+    width, height = 19, 11
+    trans_color = (255, 0, 255, 255)
+
+    def make_image(self):
+        data = bytearray()
+        for y in range(self.height):
+            for x in range(self.width):
+                if (x + y) % 7 == 0:
+                    data.extend(self.trans_color)
+                else:
+                    alpha = 0 if (x * y) % 5 == 1 else 255
+                    data.extend(((x * 37 + y * 91) % 256, (x * 53 + y * 17) % 256, (x * 11 + y * 29) % 256, alpha))
+        return FakeImage(self.width, self.height, data=data)
+
+    def transparent(self, image, i):
+        pixel = tuple(image.drawable.data[i:i + 4])
+        return pixel == self.trans_color or pixel[3] == 0
+
+    def dither(self, image, dithering=plugin.ORDERED_DITHERING):
+        pixels = plugin.PixelBuffer(image.drawable, False)
+        image_plugin = plugin.ImagePlugin(image, True, self.trans_color)
+        pixels = plugin.downsampling(image_plugin, pixels, False, dithering)
+        return bytes(bytearray(pixels.pixels))
+
+    def check_pattern(self):
+        # flat channels between two levels: 16 sits 28/64 of the way from
+        # level 0 to 1, 127 31/64 from level 3 to 4, 200 31/64 from 5 to 6
+        width, height = 20, 18
+        flat = (16, 127, 200)
+        image = FakeImage(width, height, data=bytearray(flat + (255,)) * (width * height))
+        result = bytearray(self.dither(image))
+        self.assertNotEqual(bytes(result), self.dither(image, plugin.NO_DITHERING))
+
+        pixel = lambda x, y: result[(y * width + x) * 4:(y * width + x) * 4 + 3]
+        # the pattern repeats every 8 pixels in both directions
+        for y in range(height):
+            for x in range(width):
+                self.assertEqual(pixel(x, y), pixel(x % 8, y % 8), (x, y))
+
+        for c, v in enumerate(flat):
+            position = v * 7 / 255.0
+            lower, upper = GRID[int(position)], GRID[int(position) + 1]
+            tile = [pixel(x, y)[c] for y in range(8) for x in range(8)]
+            self.assertEqual(set(tile), set((lower, upper)), v)
+            # share of the upper level follows the Bayer thresholds
+            self.assertEqual(tile.count(upper), int(round((position - int(position)) * 64)), v)
+
+    def check_grid(self, image, result):
+        for i in range(0, len(result), 4):
+            pixel = tuple(bytearray(result[i:i + 4]))
+            if self.transparent(image, i):
+                self.assertEqual(pixel, self.trans_color, i // 4)
+            else:
+                self.assertEqual(pixel[3], 255, i // 4)
+                for v in pixel[0:3]:
+                    self.assertIn(v, GRID, i // 4)
+
+    def test_pure_python(self):
+        image = self.make_image()
+        with mock.patch.object(plugin, 'np', None):
+            self.check_grid(image, self.dither(image))
+            self.check_pattern()
+
+    @unittest.skipIf(plugin.np is None, 'NumPy is not installed')
+    def test_numpy_pattern(self):
+        self.check_pattern()
+
+    @unittest.skipIf(plugin.np is None, 'NumPy is not installed')
+    def test_numpy_matches_pure_python(self):
+        image = self.make_image()
+        result = self.dither(image)
+        self.check_grid(image, result)
+        with mock.patch.object(plugin, 'np', None):
+            self.assertEqual(result, self.dither(image))
+
+
+def floyd_steinberg(data, width, height):
+    """Textbook Floyd-Steinberg over flat RGBA bytes, rounding to the LEVELS grid."""
+    pixels = [list(data[i:i + 4]) for i in range(0, len(data), 4)]
+    for y in range(height):
+        for x in range(width):
+            pixel = pixels[y * width + x]
+            old = pixel[0:3]
+            pixel[0:3] = [plugin.LEVELS[v] for v in old]
+            for dx, dy, weight in ((1, 0, 7), (-1, 1, 3), (0, 1, 5), (1, 1, 1)):
+                if 0 <= x + dx < width and y + dy < height:
+                    neighbour = pixels[(y + dy) * width + x + dx]
+                    for i in range(3):
+                        value = int(round(neighbour[i] + (old[i] - pixel[i]) * weight / 16.0))
+                        neighbour[i] = max(0, min(255, value))
+    return bytes(bytearray(v for pixel in pixels for v in pixel))
+
+
+class ErrorDiffusionTest(unittest.TestCase):
+    width, height = 13, 9
+
+    def diffuse(self, image):
+        pixels = plugin.PixelBuffer(image.drawable, False)
+        image_plugin = plugin.ImagePlugin(image, False)
+        pixels = plugin.downsampling(image_plugin, pixels, False, plugin.ERROR_DIFFUSION)
+        return bytes(bytearray(pixels.pixels))
+
+    def gradient(self):
+        data = bytearray()
+        for y in range(self.height):
+            for x in range(self.width):
+                data.extend(((x * 19 + y * 7) % 256, (x * 5 + y * 23) % 256, (255 - x * 13 - y * 11) % 256, 255))
+        return FakeImage(self.width, self.height, data=data)
+
+    def test_weights_go_to_the_right_neighbours(self):
+        # distinct errors per channel, so every weight and channel shows up on its own
+        rows = ([100, 100, 100, 255] * 3, [100, 100, 100, 255] * 3)
+        plugin.scatter_noise(rows, 1, (160, -80, 32), 3, 4)
+        self.assertEqual(rows[0], [100, 100, 100, 255] * 2 + [170, 65, 114, 255])
+        self.assertEqual(rows[1], [130, 85, 106, 255, 150, 75, 110, 255, 110, 95, 102, 255])
+
+    def test_edges_and_last_row(self):
+        # left column: nothing wraps around to the end of the line below
+        rows = ([100, 100, 100, 255] * 3, [100, 100, 100, 255] * 3)
+        plugin.scatter_noise(rows, 0, (160, 160, 160), 3, 4)
+        self.assertEqual(rows[0], [100, 100, 100, 255, 170, 170, 170, 255, 100, 100, 100, 255])
+        self.assertEqual(rows[1], [150, 150, 150, 255, 110, 110, 110, 255, 100, 100, 100, 255])
+        # right column of the last row: no neighbour is left
+        rows = ([100, 100, 100, 255] * 3,)
+        plugin.scatter_noise(rows, 2, (160, 160, 160), 3, 4)
+        self.assertEqual(rows[0], [100, 100, 100, 255] * 3)
+
+    def check_output(self):
+        image = self.gradient()
+        self.assertEqual(self.diffuse(image), floyd_steinberg(image.drawable.data, self.width, self.height))
+
+        # a flat colour between levels 0 and 1 becomes a mix of both, keeping its mean
+        image = FakeImage(16, 16, data=bytearray((16, 16, 16, 255)) * 256)
+        result = bytearray(self.diffuse(image))
+        for c in range(3):
+            channel = result[c::4]
+            self.assertEqual(set(channel), set((0, 32)))
+            self.assertAlmostEqual(sum(channel) / 256.0, 16, delta=1)
+
+    def test_pure_python(self):
+        with mock.patch.object(plugin, 'np', None):
+            self.check_output()
+
+    @unittest.skipIf(plugin.np is None, 'NumPy is not installed')
+    def test_numpy(self):
+        self.check_output()
+
+
+class RefinePaletteTest(unittest.TestCase):
+    length = plugin.MAX_COLORS - 1
+
+    def histograms(self, count=200):
+        rand = random.Random(4)
+        for _ in range(count):
+            codes = sorted(rand.sample(range(512), rand.randint(self.length + 1, 80)))
+            yield [(plugin.code_color(code), rand.randint(1, 1000)) for code in codes]
+
+    def error(self, histogram, palette):
+        """Weighted squared error of mapping every colour to its nearest palette entry."""
+        return sum(freq * min(plugin.distance_sq(color, entry) for entry, _ in palette)
+                   for color, freq in histogram)
+
+    def quantize(self, histogram, refine=True):
+        if refine:
+            return plugin.quantize_colors(histogram, self.length)
+        with mock.patch.object(plugin, 'refine_palette', lambda histogram, centers: list(centers)):
+            return plugin.quantize_colors(histogram, self.length)
+
+    def check_never_worse(self):
+        before = after = 0
+        for histogram in self.histograms():
+            palette = self.quantize(histogram)
+            self.assertEqual(len(palette), self.length)
+            refined, merged = self.error(histogram, palette), self.error(histogram, self.quantize(histogram, False))
+            self.assertLessEqual(refined, merged)
+            before += merged
+            after += refined
+        # refinement must pay off overall, not just break even
+        self.assertLess(after, before)
+
+    def test_pure_python_never_worse(self):
+        with mock.patch.object(plugin, 'np', None):
+            self.check_never_worse()
+
+    @unittest.skipIf(plugin.np is None, 'NumPy is not installed')
+    def test_numpy_never_worse(self):
+        self.check_never_worse()
+
+    @unittest.skipIf(plugin.np is None, 'NumPy is not installed')
+    def test_numpy_matches_pure_python(self):
+        for histogram in self.histograms():
+            palette = plugin.quantize_colors(histogram, self.length)
+            with mock.patch.object(plugin, 'np', None):
+                self.assertEqual(palette, plugin.quantize_colors(histogram, self.length))
+
+
+class IndexedPassThroughTest(unittest.TestCase):
+    # magenta is the transparent colour; 200 is off the 9-bit grid
+    colormap = (255, 0, 255, 200, 0, 0, 0, 200, 32)
+    trans_color = (255, 0, 255, 255)
+    # (index, alpha): transparent colour, alpha 0, then opaque indices 1, 2, 1, 0
+    data = (0, 255, 1, 0, 1, 255, 2, 255, 1, 255, 0, 255)
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        del messages[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def export(self, has_transparency, data=data):
+        folder = os.path.join(self.folder, str(has_transparency))
+        os.mkdir(folder)
+        image = FakeImage(3, 2, plugin.INDEXED, self.colormap, 2, data)
+        plugin.write_gr4(image, None, 'noname', folder, plugin.NO_DITHERING, True,
+                         has_transparency, self.trans_color, 'DAT', False)
+        self.assertEqual(messages, [])
+        with open(os.path.join(folder, 'NONAME.DAT'), 'rb') as file:
+            dat = file.read()
+        with open(os.path.join(folder, 'NONAME.PAL'), 'rb') as file:
+            pal = file.read()
+        self.assertEqual(dat[0:plugin.DAT_HEADER.size], plugin.DAT_HEADER.pack(3, 2))
+        return bytearray(dat[plugin.DAT_HEADER.size:]), bytearray(pal[plugin.BIN_HEADER.size:])
+
+    def expected_palette(self, has_transparency):
+        # LEVELS rounds 200 to level 5 and 32 to level 1
+        entries = bytearray((0x77, 0, 0x50, 0, 0x01, 5))
+        pal9bits = bytearray(2 * plugin.MAX_COLORS)
+        pal9bits[2 * has_transparency:2 * has_transparency + len(entries)] = entries
+        return pal9bits
+
+    def check(self, has_transparency):
+        if has_transparency:
+            pixels, pal9bits = self.export(True)
+            # indices move up by one; colour 0 and alpha 0 both become index 0
+            self.assertEqual(pixels, bytearray((0x00, 0x23, 0x20)))
+        else:
+            # index 0 is an ordinary colour, as long as no pixel is transparent
+            opaque = self.data[0:3] + (255,) + self.data[4:]
+            pixels, pal9bits = self.export(False, opaque)
+            self.assertEqual(pixels, bytearray((0x01, 0x12, 0x10)))
+        self.assertEqual(pal9bits, self.expected_palette(has_transparency))
+
+    def check_alpha_rejected(self):
+        # as with RGB images, alpha needs index 0 reserved for it
+        folder = os.path.join(self.folder, 'alpha')
+        os.mkdir(folder)
+        image = FakeImage(3, 2, plugin.INDEXED, self.colormap, 2, self.data)
+        plugin.write_gr4(image, None, 'noname', folder, plugin.NO_DITHERING, True,
+                         False, self.trans_color, 'DAT', True)
+        self.assertEqual(messages, ['Wrong plugin: alpha channel is being used.'])
+        self.assertEqual(os.listdir(folder), [])
+        del messages[:]
+
+    def test_pure_python(self):
+        with mock.patch.object(plugin, 'np', None):
+            self.check(True)
+            self.check(False)
+            self.check_alpha_rejected()
+
+    @unittest.skipIf(plugin.np is None, 'NumPy is not installed')
+    def test_numpy(self):
+        self.check(True)
+        self.check(False)
+        self.check_alpha_rejected()
+
+
+if __name__ == '__main__':
+    unittest.main()